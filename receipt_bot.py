@@ -1,14 +1,25 @@
 import os
+import random
+import secrets
+import asyncio
 import logging
-import json
-import base64
+import binascii
+import hashlib
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
 from telegram import Update
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from PIL import Image
 import io
 import gspread
 from google.oauth2.service_account import Credentials
-from openai import OpenAI
+import httpx
+import orjson
+from openai import AsyncOpenAI, APITimeoutError, DefaultAsyncHttpxClient
 
 # Configure logging
 logging.basicConfig(
@@ -21,159 +32,568 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 SPREADSHEET_NAME = os.getenv('SPREADSHEET_NAME', 'Receipt Tracker')
 
-# Initialize OpenAI client - we'll do this in a function to ensure env var is loaded
+# Service-account key - GOOGLE_CREDENTIALS_PATH wins if set, otherwise on Render the secret
+# file is mounted at /etc/secrets/, and locally it's read from the working directory
+RENDER_CREDENTIALS_PATH = '/etc/secrets/credentials.json'
+GOOGLE_CREDENTIALS_PATH = os.getenv('GOOGLE_CREDENTIALS_PATH') or (
+    RENDER_CREDENTIALS_PATH if os.path.exists(RENDER_CREDENTIALS_PATH) else 'credentials.json'
+)
+
+# Receipts are saved to a local journal first, then synced to Google Sheets in batches
+RECEIPTS_DB = os.getenv('RECEIPTS_DB', 'receipts.db')
+SHEETS_BATCH_SIZE = 50
+SHEETS_FLUSH_INTERVAL = 2.0  # seconds
+SHEETS_MAX_RETRY_DELAY = 60.0  # seconds, cap for the backoff while Sheets is failing
+
+# Photos are shrunk before upload - OpenAI downsamples larger images anyway
+IMAGE_MAX_SIDE = 1536
+IMAGE_JPEG_QUALITY = 75  # receipts are text, which survives stronger compression
+
+# OpenAI scales high-detail images so the short side is 768 px, so any Telegram
+# size at least that big carries every pixel the model will see
+PHOTO_MIN_SHORT_SIDE = 768
+
+# Most Telegram updates handled at once - plenty for the OpenAI limit below, without
+# letting a flood of photos pile up hundreds of downloads in memory
+MAX_CONCURRENT_UPDATES = 32
+
+# Most OpenAI vision calls allowed in flight at once, to stay under the rate limit
+OPENAI_MAX_CONCURRENCY = 5
+
+# How many extracted receipts to remember, keyed by Telegram file id and by a hash of the photo
+RECEIPT_CACHE_SIZE = 2048
+
+# Receipts sent in /batch mode go through the OpenAI Batch API (half price, results within 24h)
+OPENAI_BATCH_INTERVAL = 600  # seconds between batch submissions and status checks
+
+# With USE_WEBHOOK set, Telegram pushes updates to the public Render URL instead of being polled
+USE_WEBHOOK = os.getenv('USE_WEBHOOK')
+WEBHOOK_BASE_URL = os.getenv('RENDER_EXTERNAL_URL')
+# Telegram sends this back in a header on every update, so requests without it are rejected.
+# A random one is fine when unset, since the webhook is registered again on every start
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+PORT = int(os.getenv('PORT', '8443'))
+
+# Vision model for receipt extraction - gpt-4o-mini is the cheapest and fastest that reads receipts well
+RECEIPT_MODEL = os.getenv('RECEIPT_MODEL', 'gpt-4o-mini')
+
+# Per-request timeout and retry budget for OpenAI calls
+OPENAI_TIMEOUT = 30.0  # seconds
+OPENAI_MAX_RETRIES = 2
+OPENAI_DEADLINE = 60.0  # seconds, overall cap for a receipt including retries
+
+# Shared OpenAI client - created on first use, then reused so receipts share pooled connections
+_OPENAI_CLIENT = None
+
 def get_openai_client():
+    global _OPENAI_CLIENT
     if not OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY environment variable is not set!")
-    return OpenAI(api_key=OPENAI_API_KEY)
+    if _OPENAI_CLIENT is None:
+        _OPENAI_CLIENT = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20)
+            )
+        )
+    return _OPENAI_CLIENT
+
+# Cached Google handles - the authorized client (whose credentials refresh their own
+# access token) lives for the whole process, the worksheet is reopened if a write fails
+_GSPREAD_CLIENT = None
+_WORKSHEET = None
+_WORKSHEET_LOCK = threading.Lock()
+
+# Headers only need checking once per process, not every time the worksheet is reopened
+_HEADERS_CHECKED = False
+
+def get_gspread_client():
+    global _GSPREAD_CLIENT
+    if _GSPREAD_CLIENT is None:
+        scope = ['https://www.googleapis.com/auth/spreadsheets']
+        with open(GOOGLE_CREDENTIALS_PATH, 'rb') as f:
+            creds = Credentials.from_service_account_info(orjson.loads(f.read()), scopes=scope)
+        _GSPREAD_CLIENT = gspread.authorize(creds)
+    return _GSPREAD_CLIENT
 
-# For Render.com - we'll use the secret file path
 def setup_google_sheets():
+    global _HEADERS_CHECKED
     try:
-        # On Render, the secret file is mounted at /etc/secrets/
-        creds_path = '/etc/secrets/credentials.json'
-        
-        # Fallback for local development
-        if not os.path.exists(creds_path):
-            creds_path = 'credentials.json'
-            
-        scope = ['https://www.googleapis.com/auth/spreadsheets']
-        creds = Credentials.from_service_account_file(creds_path, scopes=scope)
-        client = gspread.authorize(creds)
-        sheet = client.open(SPREADSHEET_NAME).sheet1
+        sheet = get_gspread_client().open(SPREADSHEET_NAME).sheet1
         
-        # Create headers if sheet is empty
-        if not sheet.get_all_records():
-            sheet.append_row(["Date", "Store/Merchant", "Total Amount", "Currency", "Transaction Type", "Items", "Timestamp"])
+        # Create headers if sheet is empty - only the first row is fetched
+        if not _HEADERS_CHECKED:
+            if not sheet.row_values(1):
+                sheet.append_row(["Date", "Store/Merchant", "Total Amount", "Currency", "Transaction Type", "Items", "Timestamp"])
+            _HEADERS_CHECKED = True
         
         return sheet
     except Exception as e:
         logging.error(f"Google Sheets setup error: {e}")
         raise
 
-def extract_receipt_info_with_openai(image_bytes):
-    """Extract receipt information using OpenAI GPT-4 Vision"""
-    try:
-        # Get OpenAI client
-        client = get_openai_client()
+def get_worksheet():
+    """Return the shared worksheet, authenticating and opening it on first use"""
+    global _WORKSHEET
+    if _WORKSHEET is None:
+        with _WORKSHEET_LOCK:
+            if _WORKSHEET is None:
+                _WORKSHEET = setup_google_sheets()
+    return _WORKSHEET
+
+def reset_worksheet():
+    """Drop the cached worksheet so the next write reopens it"""
+    global _WORKSHEET
+    with _WORKSHEET_LOCK:
+        _WORKSHEET = None
+
+def append_rows_to_sheet(rows):
+    """Write a batch of rows to the sheet in a single API call"""
+    # RAW, because the cells hold text read off user photos - USER_ENTERED would turn a store
+    # name like "=IMPORTDATA(...)" into a live formula
+    get_worksheet().append_rows(rows, value_input_option='RAW', include_values_in_response=False)
+
+# Local receipt journal, opened on first use
+_JOURNAL = None
+
+def get_receipt_journal():
+    """Return the local receipt journal, creating the database on first use"""
+    global _JOURNAL
+    if _JOURNAL is None:
+        _JOURNAL = sqlite3.connect(RECEIPTS_DB, isolation_level=None)
+        _JOURNAL.execute("PRAGMA journal_mode=WAL")
+        _JOURNAL.execute("PRAGMA synchronous=NORMAL")
+        _JOURNAL.execute(
+            "CREATE TABLE IF NOT EXISTS pending ("
+            "id INTEGER PRIMARY KEY, date TEXT, store TEXT, total_amount TEXT, currency TEXT, "
+            "transaction_type TEXT, items TEXT, timestamp TEXT)"
+        )
         
-        # Convert image to base64
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        # Batch mode state, so a restart doesn't lose receipts users were promised.
+        # batch_id stays NULL until the receipt is submitted to OpenAI
+        _JOURNAL.execute(
+            "CREATE TABLE IF NOT EXISTS batch_receipts ("
+            "custom_id TEXT PRIMARY KEY, chat_id INTEGER, timestamp TEXT, request BLOB, batch_id TEXT)"
+        )
+        _JOURNAL.execute("CREATE TABLE IF NOT EXISTS batch_users (user_id INTEGER PRIMARY KEY)")
+    return _JOURNAL
+
+def journal_receipt(row_data):
+    """Save a receipt row locally; the background sync copies it to Google Sheets"""
+    get_receipt_journal().execute(
+        "INSERT INTO pending (date, store, total_amount, currency, transaction_type, items, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        row_data
+    )
+
+async def sync_pending_receipts():
+    """Copy journal rows to Google Sheets, one append_rows call per batch"""
+    journal = get_receipt_journal()
+    while True:
+        rows = journal.execute(
+            "SELECT id, date, store, total_amount, currency, transaction_type, items, timestamp "
+            "FROM pending ORDER BY id LIMIT ?",
+            (SHEETS_BATCH_SIZE,)
+        ).fetchall()
+        if not rows:
+            return
         
-        response = client.chat.completions.create(
-            model="gpt-4o",  # Using GPT-4o which is newer and cheaper
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Analyze this receipt or transaction image and extract the following information in JSON format:
-                            {
-                                "store": "store or merchant name",
-                                "date": "transaction date",
-                                "total_amount": "total amount paid",
-                                "currency": "currency used",
-                                "transaction_type": "payment type e.g., transfer, purchase, etc.",
-                                "items": "list of items purchased or description"
-                            }
-                            
-                            Rules:
-                            - If information is not available, use "Unknown"
-                            - For amounts, extract only the numerical value without symbols
-                            - For dates, use YYYY-MM-DD format if possible
-                            - For items, provide a concise description
-                            - Be accurate with the currency
-                            - For Nigerian receipts, currency is usually NGN
-                            """
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
+        await asyncio.to_thread(append_rows_to_sheet, [list(row[1:]) for row in rows])
+        
+        # Sheets is the record now, so the rows are dropped - every row up to the last id was in this batch
+        journal.execute("DELETE FROM pending WHERE id <= ?", (rows[-1][0],))
+        logging.info(f"Saved {len(rows)} receipt(s) to Google Sheets")
+
+async def run_sheet_sync(stop_event):
+    """Background task that syncs the journal to Google Sheets until stop_event is set"""
+    failures = 0
+    while not stop_event.is_set():
+        # Back off exponentially with jitter while Sheets keeps failing, so restarts don't retry in lockstep
+        delay = SHEETS_FLUSH_INTERVAL
+        if failures:
+            delay = random.uniform(SHEETS_FLUSH_INTERVAL, min(SHEETS_MAX_RETRY_DELAY, SHEETS_FLUSH_INTERVAL * 2 ** failures))
+        
+        try:
+            await asyncio.wait_for(stop_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        
+        try:
+            await sync_pending_receipts()
+            failures = 0
+        except Exception as e:
+            # The rows stay in the journal and are retried on the next run
+            failures += 1
+            logging.error(f"Failed to sync receipts to Google Sheets (attempt {failures}): {e}")
+            reset_worksheet()
+
+async def start_sheet_sync(application: Application):
+    # Open the journal now so a bad RECEIPTS_DB path fails at startup
+    get_receipt_journal()
+    
+    stop_event = asyncio.Event()
+    application.bot_data['sheet_sync_stop'] = stop_event
+    application.bot_data['sheet_sync'] = asyncio.create_task(run_sheet_sync(stop_event))
+
+async def stop_sheet_sync(application: Application):
+    # Let the current sync finish and make one last attempt before exiting
+    application.bot_data['sheet_sync_stop'].set()
+    await application.bot_data['sheet_sync']
+
+def pick_photo_size(photo_sizes):
+    """Pick the smallest version of a photo that still has full detail for OpenAI"""
+    return next(
+        (size for size in photo_sizes if min(size.width, size.height) >= PHOTO_MIN_SHORT_SIDE),
+        photo_sizes[-1]
+    )
+
+def shrink_image(image_stream):
+    """Downscale and JPEG re-encode a photo so far fewer bytes are uploaded to OpenAI"""
+    image = Image.open(image_stream)
+    
+    # JPEGs that are already small enough go as they are - re-encoding them gains nothing
+    if image.format == 'JPEG' and max(image.size) <= IMAGE_MAX_SIDE:
+        return image_stream.getvalue()
+    
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+# Recently extracted receipts, least recently used first
+_RECEIPT_CACHE = OrderedDict()
+
+def get_cached_receipt(image_key):
+    """Return the receipt previously extracted from the same photo, if any"""
+    receipt_data = _RECEIPT_CACHE.get(image_key)
+    if receipt_data is not None:
+        _RECEIPT_CACHE.move_to_end(image_key)
+    return receipt_data
+
+def cache_receipt(image_key, receipt_data):
+    _RECEIPT_CACHE[image_key] = receipt_data
+    if len(_RECEIPT_CACHE) > RECEIPT_CACHE_SIZE:
+        _RECEIPT_CACHE.popitem(last=False)
+
+# Fixed instructions for the system message - the field list comes from the response schema
+RECEIPT_PROMPT = (
+    "Extract the receipt or transaction details. Use \"Unknown\" for anything missing. "
+    "total_amount: number only. date: YYYY-MM-DD. transaction_type: e.g. transfer, purchase. "
+    "items: short description. Nigerian receipts are usually NGN."
+)
+
+# Static parts of every receipt request, built once
+RECEIPT_SYSTEM_MESSAGE = {"role": "system", "content": RECEIPT_PROMPT}
+RECEIPT_USER_TEXT = {"type": "text", "text": "Extract receipt JSON."}
+
+# Structured outputs - the model must return exactly these keys, all as strings
+RECEIPT_FIELDS = ["store", "date", "total_amount", "currency", "transaction_type", "items"]
+RECEIPT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "receipt",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {field: {"type": "string"} for field in RECEIPT_FIELDS},
+            "required": RECEIPT_FIELDS,
+            "additionalProperties": False
+        }
+    }
+}
+
+# Output cap for a receipt reply, and the bigger one for a retry when a long receipt gets cut off.
+# Batch jobs can't retry, so they get the bigger cap straight away
+RECEIPT_MAX_TOKENS = 200
+RECEIPT_RETRY_MAX_TOKENS = 600
+
+# Images this small are sent at low detail, which is billed as a single tile
+LOW_DETAIL_MAX_SIDE = 512
+
+def build_receipt_request(image_bytes, max_tokens=RECEIPT_MAX_TOKENS):
+    """Build the chat completion request for a receipt image"""
+    # Only the header is read to get the size
+    width, height = Image.open(io.BytesIO(image_bytes)).size
+    detail = "low" if max(width, height) <= LOW_DETAIL_MAX_SIDE else "auto"
+    
+    # Convert image to a base64 data URL - ASCII decoding is the cheapest for base64 output
+    image_url = "data:image/jpeg;base64," + binascii.b2a_base64(image_bytes, newline=False).decode('ascii')
+    
+    return {
+        "model": RECEIPT_MODEL,
+        "messages": [
+            RECEIPT_SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": [
+                    RECEIPT_USER_TEXT,
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                            "detail": detail
                         }
-                    ]
-                }
-            ],
-            max_tokens=1000
+                    }
+                ]
+            }
+        ],
+        "max_tokens": max_tokens,
+        "response_format": RECEIPT_RESPONSE_FORMAT
+    }
+
+def parse_receipt_content(content):
+    """Parse the model's JSON reply into a receipt dict"""
+    # A refusal comes back without content
+    if not content:
+        return {}
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        # The schema is enforced, so this only happens if the reply was cut off even after the retry
+        logging.warning(f"Failed to parse JSON from OpenAI response: {content}")
+        return {}
+
+# Extractions currently running, so the same photo sent twice at once costs one OpenAI call
+_IN_FLIGHT = {}
+
+async def extract_receipt_coalesced(image_key, image_bytes, user_slot, openai_slots):
+    """Extract and cache a receipt, sharing the result with concurrent requests for the same photo"""
+    if image_key in _IN_FLIGHT:
+        return await asyncio.shield(_IN_FLIGHT[image_key])
+    
+    # The same photo may have finished while this one was being shrunk
+    receipt_data = get_cached_receipt(image_key)
+    if receipt_data is not None:
+        return receipt_data
+    
+    # Registered before waiting for a slot, so a double-send from the same user joins this call
+    future = asyncio.get_running_loop().create_future()
+    _IN_FLIGHT[image_key] = future
+    try:
+        async with user_slot, openai_slots:
+            receipt_data = await extract_receipt_info_with_openai(image_bytes)
+        if receipt_data:
+            cache_receipt(image_key, receipt_data)
+        future.set_result(receipt_data)
+        return receipt_data
+    except Exception as e:
+        # Waiters get the same error, so a timeout is reported as a timeout to them too
+        future.set_exception(e)
+        # Retrieve it here as well, or asyncio logs it when nobody else was waiting
+        future.exception()
+        raise
+    finally:
+        if not future.done():
+            future.set_result({})
+        del _IN_FLIGHT[image_key]
+
+async def request_receipt_completion(image_bytes):
+    """Run the receipt completion, retrying once with more room if the reply was cut off"""
+    client = get_openai_client()
+    response = await client.chat.completions.create(**build_receipt_request(image_bytes))
+    if response.choices[0].finish_reason == "length":
+        logging.warning(
+            f"Receipt reply hit the {RECEIPT_MAX_TOKENS}-token cap, retrying with {RECEIPT_RETRY_MAX_TOKENS}"
+        )
+        response = await client.chat.completions.create(
+            **build_receipt_request(image_bytes, RECEIPT_RETRY_MAX_TOKENS)
         )
+    return response
+
+async def extract_receipt_info_with_openai(image_bytes):
+    """Extract receipt information using OpenAI Vision"""
+    try:
+        response = await asyncio.wait_for(request_receipt_completion(image_bytes), OPENAI_DEADLINE)
         
         # Extract JSON from response
         content = response.choices[0].message.content
-        logging.info(f"OpenAI Response: {content}")
+        logging.debug("OpenAI Response: %s", content)
         
-        # Try to parse JSON from the response
-        try:
-            # Extract JSON if it's wrapped in markdown code blocks
-            if "```json" in content:
-                json_str = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                json_str = content.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = content.strip()
-            
-            receipt_data = json.loads(json_str)
-            return receipt_data
-            
-        except json.JSONDecodeError:
-            # If JSON parsing fails, try to extract key information manually
-            logging.warning("Failed to parse JSON, extracting manually")
-            return extract_info_manually(content)
+        return parse_receipt_content(content)
             
+    except (APITimeoutError, asyncio.TimeoutError):
+        # Let the handler tell the user it was a timeout rather than a bad photo
+        logging.error("OpenAI Vision request timed out")
+        raise
     except Exception as e:
         logging.error(f"OpenAI Vision error: {e}")
         return {}
 
-def extract_info_manually(content):
-    """Fallback method to extract information from text response"""
-    data = {
-        "store": "Unknown",
-        "date": "Unknown", 
-        "total_amount": "Unknown",
-        "currency": "Unknown",
-        "transaction_type": "Unknown",
-        "items": "Unknown"
-    }
-    
-    # Simple pattern matching as fallback
-    content_lower = content.lower()
+def build_receipt_row(receipt_data, timestamp):
+    """Build a spreadsheet row from extracted receipt data"""
+    return [
+        receipt_data['date'],
+        receipt_data['store'],
+        receipt_data['total_amount'],
+        receipt_data['currency'],
+        receipt_data['transaction_type'],
+        receipt_data['items'],
+        timestamp
+    ]
+
+def format_receipt_reply(receipt_data, title):
+    """Build the chat message summarising a saved receipt"""
+    lines = [
+        title,
+        "",
+        f"🏪 Store: {receipt_data['store']}",
+        f"📅 Date: {receipt_data['date']}",
+        f"💰 Total: {receipt_data['currency']} {receipt_data['total_amount']}",
+        f"💳 Type: {receipt_data['transaction_type']}"
+    ]
+    if receipt_data['items'] and receipt_data['items'] != 'Unknown':
+        lines.append(f"🛍️ Items: {receipt_data['items']}")
+    return "\n".join(lines)
+
+def is_batch_user(user_id):
+    """Return whether the user has batch mode switched on"""
+    return get_receipt_journal().execute(
+        "SELECT 1 FROM batch_users WHERE user_id = ?", (user_id,)
+    ).fetchone() is not None
+
+def set_batch_mode(user_id, enabled):
+    if enabled:
+        get_receipt_journal().execute("INSERT OR IGNORE INTO batch_users (user_id) VALUES (?)", (user_id,))
+    else:
+        get_receipt_journal().execute("DELETE FROM batch_users WHERE user_id = ?", (user_id,))
+
+def queue_batch_receipt(custom_id, chat_id, timestamp, image_bytes):
+    """Hold a receipt in the journal for the next OpenAI batch job"""
+    request = orjson.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": build_receipt_request(image_bytes, RECEIPT_RETRY_MAX_TOKENS)
+    })
+    get_receipt_journal().execute(
+        "INSERT OR IGNORE INTO batch_receipts (custom_id, chat_id, timestamp, request) VALUES (?, ?, ?, ?)",
+        (custom_id, chat_id, timestamp, request)
+    )
+
+async def submit_openai_batch():
+    """Upload the held receipts to the OpenAI Batch API as a single job"""
+    journal = get_receipt_journal()
+    held = journal.execute("SELECT custom_id, request FROM batch_receipts WHERE batch_id IS NULL").fetchall()
+    if not held:
+        return
     
-    # Look for store/merchant
-    if "opay" in content_lower:
-        data["store"] = "OPay"
+    # If the upload fails the receipts stay held and the next run retries them
+    client = get_openai_client()
+    batch_input = b"\n".join(request for _, request in held)
+    batch_file = await client.files.create(file=("receipts.jsonl", batch_input), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
     
-    # Look for amount
-    import re
-    amount_match = re.search(r'(\d+[,.]?\d*\.?\d{0,2})', content)
-    if amount_match:
-        data["total_amount"] = amount_match.group(1).replace(',', '')
+    # OpenAI has the request bodies now, so only the batch id is kept
+    journal.executemany(
+        "UPDATE batch_receipts SET batch_id = ?, request = NULL WHERE custom_id = ?",
+        [(batch.id, custom_id) for custom_id, _ in held]
+    )
+    logging.info(f"Submitted OpenAI batch {batch.id} with {len(held)} receipt(s)")
+
+async def notify_batch_user(application: Application, chat_id, text):
+    """Message a batch-mode user, without letting one blocked chat stop the rest"""
+    try:
+        await application.bot.send_message(chat_id, text)
+    except TelegramError as e:
+        logging.error(f"Couldn't message chat {chat_id} about a batch receipt: {e}")
+
+async def collect_openai_batch(application: Application, batch_id):
+    """Save the results of a batch job once it has finished"""
+    client = get_openai_client()
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+        return
     
-    # Look for date
-    date_patterns = [
-        r'\d{4}-\d{2}-\d{2}',
-        r'\d{1,2}/\d{1,2}/\d{4}',
-        r'\d{1,2}-\d{1,2}-\d{4}',
-        r'\w+ \d{1,2}(?:st|nd|rd|th)?,? \d{4}'
-    ]
+    journal = get_receipt_journal()
+    if batch.status == "completed" and batch.output_file_id:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.content.splitlines():
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            
+            # Receipts already saved by an earlier, interrupted run are gone from the journal
+            receipt = journal.execute(
+                "SELECT chat_id, timestamp FROM batch_receipts WHERE custom_id = ? AND batch_id = ?",
+                (result["custom_id"], batch_id)
+            ).fetchone()
+            if receipt is None:
+                continue
+            
+            choice = response["body"]["choices"][0]
+            if choice.get("finish_reason") == "length":
+                logging.warning(f"Batch receipt {result['custom_id']} hit the {RECEIPT_RETRY_MAX_TOKENS}-token cap")
+            receipt_data = parse_receipt_content(choice["message"]["content"])
+            if not receipt_data:
+                continue
+            
+            chat_id, timestamp = receipt
+            journal_receipt(build_receipt_row(receipt_data, timestamp))
+            journal.execute("DELETE FROM batch_receipts WHERE custom_id = ?", (result["custom_id"],))
+            await notify_batch_user(
+                application,
+                chat_id,
+                format_receipt_reply(receipt_data, "✅ Batch receipt processed and saved!")
+            )
     
-    for pattern in date_patterns:
-        date_match = re.search(pattern, content, re.IGNORECASE)
-        if date_match:
-            data["date"] = date_match.group()
-            break
+    # Whatever is left failed, expired or was cancelled - cleared before messaging so nobody is told twice
+    failed = journal.execute("SELECT chat_id FROM batch_receipts WHERE batch_id = ?", (batch_id,)).fetchall()
+    journal.execute("DELETE FROM batch_receipts WHERE batch_id = ?", (batch_id,))
+    for (chat_id,) in failed:
+        await notify_batch_user(
+            application,
+            chat_id,
+            "❌ Sorry, a receipt from batch mode couldn't be processed. Please send it again."
+        )
     
-    # Look for currency
-    if "₦" in content or "naira" in content_lower or "ngn" in content_lower:
-        data["currency"] = "NGN"
+    logging.info(f"OpenAI batch {batch_id} finished with status {batch.status}")
+
+async def run_openai_batches(application: Application):
+    """Background task that submits held receipts and collects finished batch jobs"""
+    while True:
+        try:
+            await submit_openai_batch()
+        except Exception as e:
+            logging.error(f"OpenAI batch submission error: {e}")
+        
+        # Each batch is collected on its own, so one that keeps failing can't hold up the others
+        open_batches = get_receipt_journal().execute(
+            "SELECT DISTINCT batch_id FROM batch_receipts WHERE batch_id IS NOT NULL"
+        ).fetchall()
+        for (batch_id,) in open_batches:
+            try:
+                await collect_openai_batch(application, batch_id)
+            except Exception as e:
+                logging.error(f"OpenAI batch {batch_id} error: {e}")
+        
+        # Sleeping last means receipts resumed after a restart are handled straight away
+        await asyncio.sleep(OPENAI_BATCH_INTERVAL)
+
+async def post_init(application: Application):
+    await start_sheet_sync(application)
     
-    # Look for transaction type
-    if "transfer" in content_lower or "sent" in content_lower:
-        data["transaction_type"] = "Transfer"
-    elif "purchase" in content_lower or "payment" in content_lower:
-        data["transaction_type"] = "Purchase"
+    application.bot_data['openai_slots'] = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    # Dropped automatically once none of the user's photos are being processed
+    application.bot_data['user_openai_slots'] = weakref.WeakValueDictionary()
     
-    return data
+    # Batch receipts from before a restart are still in the journal and pick up where they left off
+    held = get_receipt_journal().execute("SELECT COUNT(*) FROM batch_receipts").fetchone()[0]
+    if held:
+        logging.info(f"Resuming {held} batch receipt(s) from the journal")
+    application.bot_data['batch_runner'] = asyncio.create_task(run_openai_batches(application))
+
+async def post_shutdown(application: Application):
+    application.bot_data['batch_runner'].cancel()
+    await stop_sheet_sync(application)
 
 # Bot command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -200,9 +620,24 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Ensure good lighting\n"
         "• Keep the receipt flat\n"
         "• Avoid glare and shadows\n"
-        "• Capture the entire receipt"
+        "• Capture the entire receipt\n\n"
+        "Not in a hurry? Send /batch to process receipts at lower cost - "
+        "results arrive within 24 hours."
     )
 
+async def batch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    batch_mode = not is_batch_user(update.effective_user.id)
+    set_batch_mode(update.effective_user.id, batch_mode)
+    
+    if batch_mode:
+        await update.message.reply_text(
+            "🕒 Batch mode is on. Receipts you send now are processed at lower cost "
+            "and saved within 24 hours - I'll message you as each one is done.\n\n"
+            "Send /batch again to go back to instant processing."
+        )
+    else:
+        await update.message.reply_text("⚡ Batch mode is off. Receipts are processed instantly again.")
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Check if OpenAI API key is available
@@ -210,59 +645,69 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ OpenAI API key is not configured. Please contact the bot administrator.")
             return
         
-        # Send processing message
-        processing_msg = await update.message.reply_text("🔄 Processing your receipt with AI...")
+        # Show "typing..." while we work - one call and nothing to clean up afterwards
+        await update.message.chat.send_action(ChatAction.TYPING)
+        
+        timestamp = update.message.date.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds')
+        photo_size = pick_photo_size(update.message.photo)
         
-        # Get the photo file
-        photo_file = await update.message.photo[-1].get_file()
+        # A resent or forwarded photo keeps its Telegram file id, so a hit skips even the download
+        receipt_data = get_cached_receipt(photo_size.file_unique_id)
         
-        # Download photo as bytes
-        photo_bytes = await photo_file.download_as_bytearray()
+        if receipt_data is None:
+            # Download photo straight into a stream that Pillow can read without another copy
+            photo_file = await photo_size.get_file()
+            photo_stream = io.BytesIO()
+            await photo_file.download_to_memory(photo_stream)
+            photo_stream.seek(0)
+            
+            # The same image uploaded again gets a new file id, so also look it up by content
+            with photo_stream.getbuffer() as photo_view:
+                image_key = hashlib.blake2b(photo_view, digest_size=16).digest()
+            receipt_data = get_cached_receipt(image_key)
         
-        # Extract receipt information using OpenAI
-        receipt_data = extract_receipt_info_with_openai(photo_bytes)
+        if receipt_data is None:
+            # Shrink it before upload, in a thread since resizing is CPU-bound
+            photo_bytes = await asyncio.to_thread(shrink_image, photo_stream)
+            
+            # In batch mode the receipt waits for the next OpenAI batch job
+            if is_batch_user(update.effective_user.id):
+                queue_batch_receipt(
+                    f"{update.message.chat_id}-{update.message.message_id}",
+                    update.message.chat_id,
+                    timestamp,
+                    photo_bytes
+                )
+                await update.message.reply_text("🕒 Receipt queued for batch processing. I'll message you once it's saved.")
+                return
+            
+            # One OpenAI call per user at a time, so a flood of photos from one chat can't take every slot
+            user_slot = context.bot_data['user_openai_slots'].get(update.effective_user.id)
+            if user_slot is None:
+                user_slot = asyncio.Semaphore(1)
+                context.bot_data['user_openai_slots'][update.effective_user.id] = user_slot
+            
+            # Extract receipt information using OpenAI
+            receipt_data = await extract_receipt_coalesced(
+                image_key, photo_bytes, user_slot, context.bot_data['openai_slots']
+            )
         
         if not receipt_data:
-            await processing_msg.delete()
             await update.message.reply_text("❌ Sorry, I couldn't process that receipt. Please try again.")
             return
         
-        # Save to Google Sheets
-        sheet = setup_google_sheets()
-        timestamp = update.message.date.strftime("%Y-%m-%d %H:%M:%S")
-        
-        row_data = [
-            receipt_data.get('date', 'Unknown'),
-            receipt_data.get('store', 'Unknown'),
-            receipt_data.get('total_amount', 'Unknown'),
-            receipt_data.get('currency', 'Unknown'),
-            receipt_data.get('transaction_type', 'Unknown'),
-            receipt_data.get('items', 'Unknown'),
-            timestamp
-        ]
-        
-        sheet.append_row(row_data)
+        cache_receipt(photo_size.file_unique_id, receipt_data)
         
-        # Prepare response message
-        response = "✅ Receipt processed and saved!\n\n"
-        response += f"🏪 Store: {receipt_data.get('store', 'Unknown')}\n"
-        response += f"📅 Date: {receipt_data.get('date', 'Unknown')}\n"
-        response += f"💰 Total: {receipt_data.get('currency', '')} {receipt_data.get('total_amount', 'Unknown')}\n"
-        response += f"💳 Type: {receipt_data.get('transaction_type', 'Unknown')}\n"
+        # Save locally - the background sync copies it to Google Sheets shortly
+        journal_receipt(build_receipt_row(receipt_data, timestamp))
         
-        items = receipt_data.get('items', 'Unknown')
-        if items and items != 'Unknown':
-            response += f"🛍️ Items: {items}\n"
-        
-        await processing_msg.delete()
+        response = format_receipt_reply(receipt_data, "✅ Receipt processed and saved!")
         await update.message.reply_text(response)
         
+    except (APITimeoutError, asyncio.TimeoutError):
+        await update.message.reply_text("⏱️ Reading that receipt took too long. Please try again in a moment.")
     except Exception as e:
         logging.error(f"Error processing receipt: {e}")
-        try:
-            await processing_msg.delete()
-        except:
-            pass
         await update.message.reply_text("❌ Sorry, I couldn't process that receipt. Please try again with a clearer image.")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -282,18 +727,46 @@ def main():
         logging.error("Please set the OPENAI_API_KEY environment variable in your Render dashboard")
         return
     
+    if USE_WEBHOOK and not WEBHOOK_BASE_URL:
+        logging.error("USE_WEBHOOK is set but RENDER_EXTERNAL_URL is not!")
+        return
+    
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Handle updates concurrently with a connection pool big enough for parallel photo downloads
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .connection_pool_size(64)
+        .pool_timeout(5.0)
+        .read_timeout(30.0)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("batch", batch_command))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     # Start bot
     logging.info("Bot is starting with OpenAI Vision...")
-    application.run_polling()
+    if USE_WEBHOOK:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            # The secret token authenticates Telegram, so the bot token stays out of URLs and access logs
+            url_path="telegram",
+            webhook_url=f"{WEBHOOK_BASE_URL}/telegram",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        # Long polling for local development
+        application.run_polling()
 
 if __name__ == "__main__":
     main()